@@ -1,8 +1,15 @@
+import io
+import itertools
+import math
+import mmap
 import os
-import random
+import queue
 import struct
 import sys
+import threading
+import time
 
+import numpy as np
 from PySide6.QtCore import QObject, Qt, QThread, Signal
 from PySide6.QtGui import QIcon, QPalette, QColor
 from PySide6.QtWidgets import (
@@ -25,6 +32,207 @@ from PySide6.QtWidgets import (
     QComboBox,
 )
 
+try:
+	from numba import njit
+except ImportError:
+	njit = None
+
+# Zemax binary ray file header and the x y z l m n flux ray record
+HEADER_STRUCT = struct.Struct('<ii100sfffffff i 3f3f3f4fiiii')
+RAY_DTYPE = np.dtype([('xyz', '<f4', (3,)), ('lmn', '<f4', (3,)), ('flux', '<f4')])
+
+# Bound str.format line formatters, called once per ray as FMT(*values)
+FMT7 = "{:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6e} \n".format
+FMT8 = "{:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6e} {:.6f} \n".format
+FMT7_TXT = "{:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6f} {:.6e}\n".format
+FMT7_TRACEPRO = "{:.6E} {:.6E} {:.6E} {:.6E} {:.6E} {:.6E} {:.6E} \n".format
+
+
+def format_rays(fmt, rays):
+	"""Format a (n, k) ray array into one text block using a bound line formatter."""
+	return ''.join(map(fmt, *rays.T.tolist()))
+
+
+def _bin_rays_numpy(lmn, flux, num_theta_bins, num_phi_bins):
+	"""Vectorized angular binning used when numba is not available."""
+	# Numerical guard: normalize direction if needed
+	len_dir = np.maximum(1e-12, np.sqrt(np.sum(lmn * lmn, axis=1)))
+	l = lmn[:, 0] / len_dir
+	m = lmn[:, 1] / len_dir
+	# Clamp n to [-1,1] to avoid NaNs
+	n = np.clip(lmn[:, 2] / len_dir, -1.0, 1.0)
+	theta = np.arccos(n)
+	phi = np.arctan2(m, l)
+	ti = np.clip((theta / np.pi * num_theta_bins).astype(np.int32), 0, num_theta_bins - 1)
+	pj = np.clip(((phi + np.pi) / (2 * np.pi) * num_phi_bins).astype(np.int32), 0, num_phi_bins - 1)
+	bin_idx = ti * num_phi_bins + pj
+	flux_per_bin = np.bincount(bin_idx, weights=np.fmax(0.0, flux), minlength=num_theta_bins * num_phi_bins)
+	return bin_idx, flux_per_bin
+
+
+def _group_by_bin_numpy(bin_idx, num_bins):
+	"""Stable grouping of ray indices by bin used when numba is not available."""
+	# 16-bit keys let NumPy use its O(N) radix sort for the stable argsort
+	keys = bin_idx.astype(np.uint16) if num_bins <= 1 << 16 else bin_idx
+	order = np.argsort(keys, kind='stable')
+	edges = np.concatenate(([0], np.cumsum(np.bincount(bin_idx, minlength=num_bins))))
+	return order, edges
+
+
+if njit is not None:
+	@njit(cache=True, fastmath=True)
+	def bin_rays(lmn, flux, num_theta_bins, num_phi_bins):
+		"""Assign each ray to a flat (theta, phi) bin index and accumulate flux per bin."""
+		n_rays = lmn.shape[0]
+		bin_idx = np.empty(n_rays, dtype=np.int32)
+		flux_per_bin = np.zeros(num_theta_bins * num_phi_bins, dtype=np.float64)
+		for i in range(n_rays):
+			l = lmn[i, 0]; m = lmn[i, 1]; n = lmn[i, 2]
+			len_dir = max(1e-12, math.sqrt(l*l + m*m + n*n))
+			l /= len_dir; m /= len_dir; n /= len_dir
+			if n > 1.0: n = 1.0
+			if n < -1.0: n = -1.0
+			theta = math.acos(n)
+			phi = math.atan2(m, l)
+			ti = min(num_theta_bins - 1, max(0, int((theta / math.pi) * num_theta_bins)))
+			pj = min(num_phi_bins - 1, max(0, int((phi + math.pi) / (2 * math.pi) * num_phi_bins)))
+			b = ti * num_phi_bins + pj
+			bin_idx[i] = b
+			flux_per_bin[b] += max(0.0, flux[i])
+		return bin_idx, flux_per_bin
+
+	@njit(cache=True)
+	def group_by_bin(bin_idx, num_bins):
+		"""Counting-sort scatter: ray indices ordered by bin (stable), plus each bin's start/end edges."""
+		edges = np.zeros(num_bins + 1, dtype=np.int64)
+		for b in bin_idx:
+			edges[b + 1] += 1
+		edges = np.cumsum(edges)
+		fill = edges[:-1].copy()
+		order = np.empty(len(bin_idx), dtype=np.int64)
+		for i in range(len(bin_idx)):
+			b = bin_idx[i]
+			order[fill[b]] = i
+			fill[b] += 1
+		return order, edges
+else:
+	bin_rays = _bin_rays_numpy
+	group_by_bin = _group_by_bin_numpy
+
+
+def apportion_samples(weights, capacity, k_target):
+	"""Largest-remainder (Hamilton) apportionment of k_target samples over bins, capped by capacity."""
+	weights = np.where(np.isfinite(weights), weights, 0.0)
+	alloc = np.zeros(len(capacity), dtype=np.int64)
+	remaining = k_target
+	while remaining > 0:
+		spare = capacity - alloc
+		w = np.where(spare > 0, weights, 0.0)
+		if w.sum() <= 0:
+			# No weighted bin has room left (or all weights are zero): fall back to counts
+			w = spare.astype(np.float64)
+		raw = remaining * w / w.sum()
+		base = np.minimum(np.floor(raw).astype(np.int64), spare)
+		if base.sum() == 0:
+			# Every share is below one: top up the bins with the largest remainders
+			alloc[np.argpartition(raw, -remaining)[-remaining:]] += 1
+			break
+		alloc += base
+		remaining -= int(base.sum())
+	return alloc
+
+
+def count_ray_lines(buf):
+	"""Count the lines of a bytes-like buffer that hold exactly 7 whitespace-separated values."""
+	data = np.frombuffer(buf, dtype=np.uint8)
+	if data.size == 0:
+		return 0
+	# Same whitespace as bytes.split(): space and \t \n \v \f \r (9..13)
+	space = (data == 32) | ((data - np.uint8(9)) < 5)
+	# A value starts at every non-space byte that follows a space (or the buffer start)
+	starts = ~space
+	starts[1:] &= space[:-1]
+	line_ends = np.flatnonzero(data == ord('\n'))
+	n_lines = line_ends.size + int(data[-1] != ord('\n'))
+	line_of_value = np.searchsorted(line_ends, np.flatnonzero(starts))
+	return int(np.count_nonzero(np.bincount(line_of_value, minlength=n_lines) == 7))
+
+
+def fadvise(fd, offset, length, advice):
+	"""Best-effort os.posix_fadvise by constant name; a no-op where unsupported (e.g. Windows)."""
+	if hasattr(os, 'posix_fadvise') and hasattr(os, advice):
+		try:
+			os.posix_fadvise(fd, offset, length, getattr(os, advice))
+		except OSError:
+			pass
+
+
+def throttled(emit, interval=0.05):
+	"""Wrap a signal emit so it fires at most once per interval seconds (~20 updates/s by default)."""
+	last_emit = -interval
+
+	def emit_throttled(value):
+		nonlocal last_emit
+		now = time.monotonic()
+		if now - last_emit >= interval:
+			last_emit = now
+			emit(value)
+
+	return emit_throttled
+
+
+def find_header(f):
+	"""Read a binary file object up to the ray header line; return (header, byte offset just past it)."""
+	for line in iter(f.readline, b''):
+		parts = line.split()
+		if len(parts) == 4 and parts[0].isdigit():
+			return line.decode(errors='replace').strip(), f.tell()
+	raise ValueError("No ray header found")
+
+
+def iter_rays(path, block_bytes=1 << 23):
+	"""Stream the rays that follow the header of an ASCII ray file as (n, 7) float64 blocks.
+
+	Yields (block, byte offset reached). A block that is not a clean 7-column table
+	(trailers, notes, short lines) keeps only its 7-value lines.
+	"""
+	with open(path, 'rb') as f:
+		fadvise(f.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+		find_header(f)
+		while True:
+			chunk = f.read(block_bytes)
+			if not chunk:
+				return
+			# Finish the last line so no ray is split across two blocks
+			chunk += f.readline()
+			try:
+				block = np.loadtxt(io.BytesIO(chunk), dtype=np.float64, comments=None, ndmin=2)
+			except ValueError:
+				block = None
+			if block is None or block.shape[1] != 7:
+				lines = [line for line in chunk.split(b'\n') if len(line.split()) == 7]
+				block = np.loadtxt(lines, dtype=np.float64, comments=None, ndmin=2) if lines else np.empty((0, 7))
+			yield block, f.tell()
+
+
+def scan_ray_file(path):
+	"""Return the header line and ray count of an ASCII ray file without loading it into memory."""
+	with open(path, 'rb') as f:
+		header, header_offset = find_header(f)
+		# Count the 7-value lines after the header over a memory map, in windows cut at line breaks
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+				mm.madvise(mmap.MADV_SEQUENTIAL)
+			n_rays = 0
+			window = 1 << 22
+			start = header_offset
+			while start < len(mm):
+				end = mm.find(b'\n', min(start + window, len(mm)) - 1)
+				end = len(mm) if end < 0 else end + 1
+				n_rays += count_ray_lines(mm[start:end])
+				start = end
+	return header, n_rays
+
 
 class DatToTxtWorker(QObject):
 	progress_changed = Signal(int)
@@ -42,14 +250,12 @@ class DatToTxtWorker(QObject):
 			self.progress_changed.emit(0)
 			self.status_changed.emit("Reading binary header...")
 
-			header_fmt = '<ii100sfffffff i 3f3f3f4fiiii'
-			header_size = struct.calcsize(header_fmt)
-
 			with open(self.input_file, 'rb') as fin:
-				head_data = fin.read(header_size)
-				if len(head_data) != header_size:
+				fadvise(fin.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+				head_data = fin.read(HEADER_STRUCT.size)
+				if len(head_data) != HEADER_STRUCT.size:
 					raise ValueError("File too small to contain valid header")
-				header = struct.unpack(header_fmt, head_data)
+				header = HEADER_STRUCT.unpack_from(head_data)
 				identifier = header[0]
 				nbr_rays = header[1]
 				description = header[2]
@@ -74,33 +280,39 @@ class DatToTxtWorker(QObject):
 				if ray_format_type == 0:
 					if not (flux_type == 0 or flux_type == 1):
 						raise ValueError(f"Incorrect flux type identifier: {flux_type}")
-					ray_fmt = '<7f'  # x y z l m n flux
-					ray_floats = 7
+					ray_floats = 7  # x y z l m n flux
+					ray_fmt = FMT7
 				else:
 					if flux_type != 0:
 						raise ValueError(f"Incorrect flux type identifier: {flux_type}")
-					ray_fmt = '<8f'  # x y z l m n flux wavelength
-					ray_floats = 8
+					ray_floats = 8  # x y z l m n flux wavelength
+					# 8 values for spectral color; match C order
+					ray_fmt = FMT8
 
 				self.status_changed.emit("Writing ASCII header...")
 				with open(self.output_file, 'w') as fout:
 					fout.write(f"{nbr_rays} {dimension_units} {ray_format_type} {flux_type} \n")
 
 					self.status_changed.emit("Converting rays...")
-					ray_size = struct.calcsize(ray_fmt)
-					for i in range(nbr_rays):
-						if i % 10000 == 0:
-							self.progress_changed.emit(int((i / max(1, nbr_rays)) * 100))
-							# keep UI responsive
-						ray_data = fin.read(ray_size)
-						if len(ray_data) != ray_size:
-							raise ValueError(f"Unexpected EOF at ray {i}")
-						vals = struct.unpack(ray_fmt, ray_data)
-						if ray_floats == 7:
-							fout.write(' '.join([f"{v:.6f}" for v in vals[:6]] + [f"{vals[6]:.6e}"]) + " \n")
-						else:
-							# 8 values for spectral color; match C order
-							fout.write(' '.join([f"{v:.6f}" for v in vals[:6]] + [f"{vals[6]:.6e}", f"{vals[7]:.6f}"]) + " \n")
+					# Read chunks on a background thread while this thread formats and writes them
+					chunks = queue.Queue(maxsize=4)
+					stop = threading.Event()
+					reader = threading.Thread(target=self._read_chunks, args=(fin, nbr_rays, ray_floats, chunks, stop), daemon=True)
+					reader.start()
+					report_progress = throttled(self.progress_changed.emit)
+					try:
+						while True:
+							item = chunks.get()
+							if item is None:
+								break
+							if isinstance(item, Exception):
+								raise item
+							start, rays = item
+							report_progress(int((start / max(1, nbr_rays)) * 100))
+							fout.write(format_rays(ray_fmt, rays))
+					finally:
+						stop.set()
+						reader.join()
 
 			self.progress_changed.emit(100)
 			self.status_changed.emit("Conversion complete")
@@ -111,6 +323,36 @@ class DatToTxtWorker(QObject):
 			self.progress_changed.emit(0)
 			self.status_changed.emit("")
 
+	def _read_chunks(self, fin, nbr_rays, ray_floats, chunks, stop, chunk_rays=262144):
+		# Producer: queue (start, rays) blocks, then None; a read error is queued in place of data.
+		# The input is read exactly once, so consumed regions are dropped from the page cache.
+		def put(item):
+			while not stop.is_set():
+				try:
+					chunks.put(item, timeout=0.1)
+					return True
+				except queue.Full:
+					continue
+			return False
+
+		dropped = 0
+		try:
+			for start in range(0, nbr_rays, chunk_rays):
+				count = min(chunk_rays, nbr_rays - start)
+				rays = np.fromfile(fin, dtype='<f4', count=count * ray_floats)
+				if rays.size != count * ray_floats:
+					raise ValueError(f"Unexpected EOF at ray {start + rays.size // ray_floats}")
+				pos = fin.tell()
+				if pos - dropped >= 1 << 26:
+					fadvise(fin.fileno(), dropped, pos - dropped, 'POSIX_FADV_DONTNEED')
+					dropped = pos
+				if not put((start, rays.reshape(count, ray_floats))):
+					return
+		except Exception as e:
+			put(e)
+			return
+		put(None)
+
 
 class SubsampleWorker(QObject):
 	progress_changed = Signal(int)
@@ -118,13 +360,14 @@ class SubsampleWorker(QObject):
 	finished = Signal(str)
 	error = Signal(str)
 
-	def __init__(self, input_file, target_rays, output_file, output_format, method):
+	def __init__(self, input_file, target_rays, output_file, output_format, method, seed=None):
 		super().__init__()
 		self.input_file = input_file
 		self.target_rays = target_rays
 		self.output_file = output_file
 		self.output_format = output_format
 		self.method = method  # 'random' or 'angular_stratified'
+		self.rng = np.random.default_rng(seed)  # seed=None draws fresh OS entropy
 
 	def run(self):
 		try:
@@ -133,67 +376,62 @@ class SubsampleWorker(QObject):
 			if self.input_file.lower().endswith('.dat'):
 				raise ValueError("Binary .dat not supported for subsampling. Convert to ASCII .txt first.")
 
-			with open(self.input_file, 'r') as f:
-				lines = f.readlines()
+			# Stop reading as soon as the header line is found; readers below seek past it
+			with open(self.input_file, 'rb') as f:
+				header, header_offset = find_header(f)
 
-			header_index = next(i for i, line in enumerate(lines) if len(line.split()) == 4 and line.split()[0].isdigit())
-			header = lines[header_index].strip()
+			sampled_rays = None
+			if self.method == 'random':
+				sampled_rays = self._subsample_random_streamed(header_offset, self.target_rays)
 
-			ray_lines = []
-			total_lines = max(1, len(lines) - (header_index + 1))
-			for i, line in enumerate(lines[header_index + 1:]):
-				if i % 10000 == 0:
-					self.progress_changed.emit(int((i / total_lines) * 50))
-				stripped = line.strip()
-				if len(stripped.split()) == 7:
-					ray_lines.append(line)
+			if sampled_rays is None:
+				rays = self._load_rays()
 
-			if len(ray_lines) < self.target_rays:
-				raise ValueError(f"File has only {len(ray_lines)} rays")
+				if len(rays) < self.target_rays:
+					raise ValueError(f"File has only {len(rays)} rays")
 
-			self.status_changed.emit("Subsampling...")
-			self.progress_changed.emit(50)
-			if self.method == 'random':
-				sampled_rays = random.sample(ray_lines, self.target_rays)
-			else:
-				sampled_rays = self._subsample_angular_stratified(ray_lines, self.target_rays)
+				self.status_changed.emit("Subsampling...")
+				self.progress_changed.emit(50)
+				if self.method == 'random':
+					sample_idx = np.sort(self.rng.choice(len(rays), size=self.target_rays, replace=False, shuffle=False))
+				else:
+					sample_idx = self._subsample_angular_stratified(rays, self.target_rays)
+				sampled_rays = rays[sample_idx]
 
 			self.status_changed.emit("Scaling fluxes...")
 			original_ray_count = int(header.split()[0])
 			scale_factor = original_ray_count / self.target_rays
 
-			ray_data = []
-			import math
-			for i, line in enumerate(sampled_rays):
-				if i % 10000 == 0:
-					self.progress_changed.emit(50 + int((i / max(1, self.target_rays)) * 10))
-				fields = line.strip().split()
-				ray = [float(f) for f in fields]
-				# Scale and sanitize flux to ensure Zemax compatibility
-				flux_val = ray[6] * scale_factor
-				if (not math.isfinite(flux_val)) or flux_val <= 0.0:
-					flux_val = 1e-30
-				ray[6] = float(flux_val)
-				ray_data.append(ray)
-
-			sum_flux = sum(r[6] for r in ray_data)
+			# Scale and sanitize flux to ensure Zemax compatibility
+			ray_data = sampled_rays
+			flux = ray_data[:, 6]
+			flux *= scale_factor
+			bad = ~np.isfinite(flux) | (flux <= 0.0)
+			flux[bad] = 1e-30
+			assert np.all(np.isfinite(flux)) and np.all(flux > 0.0)
+			sum_flux = float(flux.sum())
 			parts = header.split()
 			parts[0] = str(self.target_rays)
 			new_header = ' '.join(parts) + '\n'
 
 			self.status_changed.emit("Saving file...")
 			self.progress_changed.emit(60)
+			report_progress = throttled(self.progress_changed.emit)
+			# Text outputs are formatted and written in blocks of rays rather than line by line
+			write_chunk = 50000
 
 			if self.output_format == 'txt':
-				with open(self.output_file, 'w') as f:
+				with open(self.output_file, 'w', buffering=1 << 20) as f:
 					f.write(new_header)
-					for ray in ray_data:
-						f.write(' '.join([f"{v:.6f}" for v in ray[:6]] + [f"{ray[6]:.6e}"]) + '\n')
+					for start in range(0, len(ray_data), write_chunk):
+						report_progress(60 + int((start / max(1, self.target_rays)) * 40))
+						chunk = ray_data[start:start + write_chunk]
+						f.write(format_rays(FMT7_TXT, chunk))
 			elif self.output_format == 'tracepro':
 				# Write TracePro ASCII .dat format
 				requested = original_ray_count
 				generated = self.target_rays
-				with open(self.output_file, 'w') as f:
+				with open(self.output_file, 'w', buffering=1 << 20) as f:
 					f.write(f"!! Source file: {self.input_file}\n")
 					f.write(f"# NbrRays Requested: {requested},  NbrRays Generated: {generated}\n")
 					# Use generic angular range and identity transforms
@@ -203,15 +441,10 @@ class SubsampleWorker(QObject):
 					f.write("Scale X   1.0000, Y   1.0000, Z   1.0000\n")
 					f.write("Conversion Factor From Meters   1.0000\n")
 					f.write("X Pos Y Pos Z Pos X Vec Y Vec Z Vec Inc Flux\n")
-					for i, ray in enumerate(ray_data):
-						if i % 10000 == 0:
-							self.progress_changed.emit(60 + int((i / max(1, self.target_rays)) * 40))
-						x, y, z, l, m, n, flux_val = ray[:7]
-						# Sanitize flux
-						import math
-						if (not math.isfinite(flux_val)) or flux_val <= 0.0:
-							flux_val = 1e-30
-						f.write(f"{x:.6E} {y:.6E} {z:.6E} {l:.6E} {m:.6E} {n:.6E} {flux_val:.6E} \n")
+					for start in range(0, len(ray_data), write_chunk):
+						report_progress(60 + int((start / max(1, self.target_rays)) * 40))
+						chunk = ray_data[start:start + write_chunk]
+						f.write(format_rays(FMT7_TRACEPRO, chunk))
 			else:
 				identifier = 8675309
 				nbr_rays = self.target_rays
@@ -232,7 +465,7 @@ class SubsampleWorker(QObject):
 				flux_type = int(parts[3])
 				reserved1, reserved2 = 0, 0
 
-				header_pack = struct.pack('<ii100sfffffff i 3f3f3f4fiiii',
+				header_pack = HEADER_STRUCT.pack(
 					identifier, nbr_rays, description,
 					source_flux, ray_set_flux, wavelength,
 					azimuth_beg, azimuth_end, polar_beg, polar_end,
@@ -244,16 +477,14 @@ class SubsampleWorker(QObject):
 					ray_format_type, flux_type,
 					reserved1, reserved2)
 
+				# Pack rays into little-endian float32 records and write them in a single call
+				out = np.empty(len(ray_data), dtype=RAY_DTYPE)
+				out['xyz'] = ray_data[:, 0:3]
+				out['lmn'] = ray_data[:, 3:6]
+				out['flux'] = ray_data[:, 6]
 				with open(self.output_file, 'wb') as f:
 					f.write(header_pack)
-					for i, ray in enumerate(ray_data):
-						if i % 10000 == 0:
-							self.progress_changed.emit(60 + int((i / max(1, self.target_rays)) * 40))
-						# Ensure per-ray flux is finite and >0 before write
-						fv = ray[6]
-						if (not math.isfinite(fv)) or fv <= 0.0:
-							fv = 1e-30
-						f.write(struct.pack('<6ff', ray[0], ray[1], ray[2], ray[3], ray[4], ray[5], fv))
+					out.tofile(f)
 
 			self.progress_changed.emit(100)
 			self.status_changed.emit("Done!")
@@ -264,98 +495,88 @@ class SubsampleWorker(QObject):
 			self.progress_changed.emit(0)
 			self.status_changed.emit("")
 
-	def _subsample_angular_stratified(self, ray_lines, k_target):
+	def _load_rays(self):
+		# Size the array from a raw line-break count (an upper bound on the rays) and
+		# fill it block by block, so the parsed rays are never held twice
+		with open(self.input_file, 'rb') as f:
+			max_rays = sum(buf.count(b'\n') for buf in iter(lambda: f.read(1 << 24), b'')) + 1
+			file_size = max(1, f.tell())
+		rays = np.empty((max_rays, 7), dtype=np.float64)
+		filled = 0
+		report_progress = throttled(self.progress_changed.emit)
+		for block, offset in iter_rays(self.input_file):
+			rays[filled:filled + len(block)] = block
+			filled += len(block)
+			report_progress(int((offset / file_size) * 50))
+		return rays[:filled]
+
+	def _subsample_random_streamed(self, header_offset, k_target):
+		# Count lines after the header without decoding them, pick k line numbers,
+		# then keep only those lines on a second pass. Returns None when the body
+		# is not a plain list of rays so the caller can fall back to a full load.
+		with open(self.input_file, 'rb') as f:
+			fadvise(f.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+			f.seek(header_offset)
+			n_lines = 0
+			last = b'\n'
+			for buf in iter(lambda: f.read(1 << 20), b''):
+				n_lines += buf.count(b'\n')
+				last = buf[-1:]
+			if last != b'\n':
+				n_lines += 1
+		if n_lines < k_target:
+			return None
+
+		self.status_changed.emit("Subsampling...")
+		self.progress_changed.emit(25)
+		picks = np.sort(self.rng.choice(n_lines, size=k_target, replace=False, shuffle=False)).tolist()
+		picked_lines = []
+		with open(self.input_file, 'rb') as f:
+			fadvise(f.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+			f.seek(header_offset)
+			# Skip the lines between picks inside islice rather than testing every line in Python
+			append = picked_lines.append
+			pos = 0
+			for pick in picks:
+				line = next(itertools.islice(f, pick - pos, None), None)
+				if line is None:
+					break
+				append(line.decode(errors='replace'))
+				pos = pick + 1
+
+		if len(picked_lines) != k_target or any(len(line.split()) != 7 for line in picked_lines):
+			return None
+		self.progress_changed.emit(50)
+		return np.loadtxt(picked_lines, dtype=np.float64, ndmin=2)
+
+	def _subsample_angular_stratified(self, rays, k_target):
 		# Bin by (theta, phi) derived from direction cosines (l, m, n)
 		# theta in [0, pi], phi in [-pi, pi)
 		# Choose a modest grid that preserves structure without huge overhead
 		num_theta_bins = 90
 		num_phi_bins = 180
-		bins = {}
-		flux_in_bin = {}
-
-		# Prepass: assign rays to bins and accumulate flux
-		for line in ray_lines:
-			parts = line.strip().split()
-			if len(parts) != 7:
-				continue
-			l = float(parts[3]); m = float(parts[4]); n = float(parts[5])
-			flux = float(parts[6])
-			# Numerical guard: normalize direction if needed
-			len_dir = max(1e-12, (l*l + m*m + n*n) ** 0.5)
-			l /= len_dir; m /= len_dir; n /= len_dir
-			# Clamp n to [-1,1] to avoid NaNs
-			if n > 1.0: n = 1.0
-			if n < -1.0: n = -1.0
-			# theta = arccos(n), phi = atan2(m, l)
-			# Use math from Python stdlib without importing anew (already allowed)
-			import math
-			theta = math.acos(n)
-			phi = math.atan2(m, l)
-			# Map to bin indices
-			ti = min(num_theta_bins - 1, max(0, int((theta / math.pi) * num_theta_bins)))
-			phi_norm = (phi + math.pi) / (2 * math.pi)  # 0..1
-			pj = min(num_phi_bins - 1, max(0, int(phi_norm * num_phi_bins)))
-			key = (ti, pj)
-			bins.setdefault(key, []).append(line)
-			flux_in_bin[key] = flux_in_bin.get(key, 0.0) + max(0.0, flux)
-
-		if not bins:
-			return random.sample(ray_lines, k_target)
-
-		# Allocate samples per bin proportional to flux; fallback to counts if zero flux
-		total_flux = sum(flux_in_bin.values())
-		if total_flux <= 0:
-			# fall back to counts
-			counts = {k: len(v) for k, v in bins.items()}
-			total_count = sum(counts.values())
-			alloc = {k: int(round(k_target * (counts[k] / max(1, total_count)))) for k in bins}
-		else:
-			alloc = {k: int(round(k_target * (flux_in_bin[k] / total_flux))) for k in bins}
-
-		# Ensure at least 1 in non-empty bins, and adjust to exact k_target
-		# First pass: cap by bin size
-		alloc = {k: min(len(bins[k]), max(1, v)) for k, v in alloc.items()}
-		current_total = sum(alloc.values())
-		# If too many, remove from bins with smallest residual until match
-		if current_total > k_target:
-			# sort bins by (alloc - 1) descending keep >=1, remove where possible
-			for k in sorted(alloc.keys(), key=lambda kk: alloc[kk], reverse=True):
-				while current_total > k_target and alloc[k] > 1:
-					alloc[k] -= 1
-					current_total -= 1
-					if current_total == k_target:
-						break
-		# If too few, add where there is remaining capacity
-		elif current_total < k_target:
-			for k in sorted(alloc.keys(), key=lambda kk: len(bins[kk]) - alloc[kk], reverse=True):
-				while current_total < k_target and alloc[k] < len(bins[k]):
-					alloc[k] += 1
-					current_total += 1
-					if current_total == k_target:
-						break
-
-		# Sample within bins
-		result = []
-		for key, lines in bins.items():
-			k = alloc.get(key, 0)
-			if k <= 0:
-				continue
-			if k >= len(lines):
-				result.extend(lines)
-			else:
-				result.extend(random.sample(lines, k))
+		num_bins = num_theta_bins * num_phi_bins
+
+		# Prepass: assign rays to bins and accumulate flux (JIT-compiled when numba is available)
+		bin_idx, flux_per_bin = bin_rays(rays[:, 3:6], rays[:, 6], num_theta_bins, num_phi_bins)
+
+		# Group ray indices by bin in random order: shuffle once, then a stable counting-sort scatter
+		perm = self.rng.permutation(len(rays))
+		grouped, edges = group_by_bin(bin_idx[perm], num_bins)
+		order = perm[grouped]
+		sorted_bins = bin_idx[order]
+		count_per_bin = np.diff(edges)
+
+		# Ensure at least 1 in non-empty bins when the budget allows, then allocate the rest
+		# proportional to flux, capped by bin size; the total is exactly k_target
+		floor_alloc = np.minimum(count_per_bin, 1)
+		if floor_alloc.sum() > k_target:
+			floor_alloc[:] = 0
+		alloc = floor_alloc + apportion_samples(flux_per_bin, count_per_bin - floor_alloc, k_target - int(floor_alloc.sum()))
 
-		# Trim or pad if slight rounding overshoot remains
-		if len(result) > k_target:
-			result = result[:k_target]
-		elif len(result) < k_target:
-			# pad with random from remaining pool (build set once to avoid O(N^2))
-			result_set = set(result)
-			remaining = [l for l in ray_lines if l not in result_set]
-			need = k_target - len(result)
-			if remaining:
-				result.extend(random.sample(remaining, min(need, len(remaining))))
-		return result
+		# Sample within bins: keep the first alloc[b] rays of each bin's shuffled run
+		rank = np.arange(len(order)) - edges[sorted_bins]
+		return order[rank < alloc[sorted_bins]]
 
 
 def is_dark_mode():
@@ -460,6 +681,11 @@ class RaySubsamplerWindow(QMainWindow):
 		self.method_combo.addItem("Random", userData='random')
 		self.method_combo.addItem("Angular stratified", userData='angular_stratified')
 		method_row.addWidget(self.method_combo)
+		method_row.addWidget(QLabel("Seed:"))
+		self.seed_input = QLineEdit()
+		self.seed_input.setPlaceholderText("random")
+		self.seed_input.setClearButtonEnabled(True)
+		method_row.addWidget(self.seed_input)
 		method_row.addStretch(1)
 		root_layout.addLayout(method_row)
 
@@ -744,12 +970,7 @@ class RaySubsamplerWindow(QMainWindow):
 		self.file_label.setText(os.path.basename(fname))
 
 		try:
-			with open(fname, 'r') as f:
-				lines = f.readlines()
-			header_index = next(i for i, line in enumerate(lines) if len(line.split()) == 4 and line.split()[0].isdigit())
-			self.header = lines[header_index].strip()
-			ray_lines = [line for line in lines[header_index + 1:] if len(line.split()) == 7]
-			self.ray_count = len(ray_lines)
+			self.header, self.ray_count = scan_ray_file(fname)
 			self.ray_count_label.setText(f"Ray count: {self.ray_count}")
 		except Exception as e:
 			QMessageBox.critical(self, "Error", f"Failed to scan file: {e}")
@@ -760,12 +981,7 @@ class RaySubsamplerWindow(QMainWindow):
 		self.input_file = path
 		self.file_label.setText(os.path.basename(path))
 		try:
-			with open(path, 'r') as f:
-				lines = f.readlines()
-			header_index = next(i for i, line in enumerate(lines) if len(line.split()) == 4 and line.split()[0].isdigit())
-			self.header = lines[header_index].strip()
-			ray_lines = [line for line in lines[header_index + 1:] if len(line.split()) == 7]
-			self.ray_count = len(ray_lines)
+			self.header, self.ray_count = scan_ray_file(path)
 			self.ray_count_label.setText(f"Ray count: {self.ray_count}")
 			QMessageBox.information(self, "Conversion Complete", f"File converted and loaded successfully!\n\nRay count: {self.ray_count}")
 		except Exception as e:
@@ -782,6 +998,15 @@ class RaySubsamplerWindow(QMainWindow):
 			QMessageBox.critical(self, "Error", "Invalid target rays")
 			return
 
+		seed_text = self.seed_input.text().strip()
+		try:
+			seed = int(seed_text) if seed_text else None
+			if seed is not None and seed < 0:
+				raise ValueError
+		except ValueError:
+			QMessageBox.critical(self, "Error", "Invalid seed (leave empty or enter a non-negative integer)")
+			return
+
 		if self.radio_txt.isChecked():
 			output_format = 'txt'
 			filters = "TXT files (*.txt)"
@@ -809,7 +1034,7 @@ class RaySubsamplerWindow(QMainWindow):
 
 		self.worker_thread = QThread()
 		method_code = self.method_combo.currentData()
-		self.worker = SubsampleWorker(self.input_file, target_rays, outfile, output_format, method_code)
+		self.worker = SubsampleWorker(self.input_file, target_rays, outfile, output_format, method_code, seed)
 		self.worker.moveToThread(self.worker_thread)
 		self.worker_thread.started.connect(self.worker.run)
 		self.worker.progress_changed.connect(self.progress.setValue)